@@ -1,8 +1,50 @@
+from urllib.parse import urlsplit
+
 from . import inosmi_ru
 from .exceptions import ArticleNotFound
 
-__all__ = ['SANITIZERS', 'ArticleNotFound']
+__all__ = [
+    'SANITIZERS',
+    'SANITIZERS_BY_HOST',
+    'ArticleNotFound',
+    'get_sanitizer',
+    'reject_unsupported_site'
+]
 
 SANITIZERS = {
     'inosmi_ru': inosmi_ru.sanitize
 }
+
+SANITIZERS_BY_HOST = {
+    'inosmi.ru': inosmi_ru.sanitize
+}
+
+
+def reject_unsupported_site(html, plaintext=False):
+    """Sanitizer for sites without an adapter, process_article skips it."""
+    raise ArticleNotFound()
+
+
+def get_sanitizer(url):
+    """Return a sanitizer for the url host.
+
+    Pages of unsupported sites are rejected without parsing.
+    """
+    try:
+        host = urlsplit(url).hostname or ''
+    except ValueError:
+        host = ''
+    return SANITIZERS_BY_HOST.get(
+        host.removeprefix('www.'),
+        reject_unsupported_site
+    )
+
+
+def test_get_sanitizer():
+    article_url = 'https://inosmi.ru/social/20201205/248649230.html'
+    www_article_url = 'https://www.inosmi.ru/social/20201205/248649230.html'
+    assert get_sanitizer(article_url) is inosmi_ru.sanitize
+    assert get_sanitizer(www_article_url) is inosmi_ru.sanitize
+    assert get_sanitizer('http://example.com') is reject_unsupported_site
+    assert get_sanitizer('invalid_url') is reject_unsupported_site
+    assert get_sanitizer('http://[invalid') is reject_unsupported_site
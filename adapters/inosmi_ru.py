@@ -3,11 +3,11 @@ import requests
 import pytest
 
 from .exceptions import ArticleNotFound
-from .html_tools import remove_buzz_attrs, remove_buzz_tags, remove_all_tags
+from .html_tools import remove_buzz_attrs, remove_buzz_tags
 
 
 def sanitize(html, plaintext=False):
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = BeautifulSoup(html, 'lxml')
     articles = soup.select("article.article")
 
     if len(articles) != 1:
@@ -24,13 +24,13 @@ def sanitize(html, plaintext=False):
     for el in buzz_blocks:
         el.decompose()
 
-    remove_buzz_attrs(article)
-    remove_buzz_tags(article)
-
     if not plaintext:
+        remove_buzz_attrs(article)
+        remove_buzz_tags(article)
         text = article.prettify()
     else:
-        remove_all_tags(article)
+        # get_text() ignores tags and attributes, so only drop blacklisted tags
+        remove_buzz_tags(article, unwraplist=[])
         text = article.get_text()
     return text.strip()
 
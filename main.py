@@ -1,116 +1,239 @@
 import asyncio
+import codecs
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import contextlib
 from enum import Enum
-import json
+import functools
 import logging
+import multiprocessing
 import os
+from pathlib import Path
+import sys
+import time
 
 import aiohttp
 from aiohttp import web, ClientConnectorError, ClientResponseError, InvalidURL
-from anyio import create_task_group
-from async_timeout import timeout
-import pymorphy2
+import charset_normalizer
+import orjson
+import pymorphy3
 import pytest
 
-from adapters import SANITIZERS, exceptions
-from text_tools import split_by_words, calculate_jaundice_rate
+from adapters import (
+    SANITIZERS,
+    exceptions,
+    get_sanitizer,
+    reject_unsupported_site
+)
+from text_tools import (
+    Deadline,
+    SplittingInterrupted,
+    calculate_jaundice_rate,
+    preload_normal_forms,
+    split_by_words_sync
+)
 
 
 logger = logging.getLogger('main')
 
 TIMEOUT_SECONDS = 5
+MAX_RESPONSE_BYTES = 5 * 1024 * 1024
+RESPONSE_CHUNK_BYTES = 64 * 1024
 
 
-class ProcessingStatus(Enum):
+class ProcessingStatus(str, Enum):
     OK = 'OK'
     FETCH_ERROR = 'FETCH_ERROR'
     PARSING_ERROR = 'PARSING_ERROR'
     TIMEOUT = 'TIMEOUT'
+    TOO_LARGE = 'TOO_LARGE'
+    PROCESSING_ERROR = 'PROCESSING_ERROR'
 
 
 POSITIVE_WORDS_FILEPATH = os.path.join('charged_dict', 'positive_words.txt')
 NEGATIVE_WORDS_FILEPATH = os.path.join('charged_dict', 'negative_words.txt')
 
 
+@functools.lru_cache(maxsize=1)
 def get_charged_words():
-    charged_words = []
+    charged_words = set()
     for path in [POSITIVE_WORDS_FILEPATH, NEGATIVE_WORDS_FILEPATH]:
-        with open(path, 'r') as file:
-            charged_words.extend([word.strip() for word in file])
-    return charged_words
+        text = Path(path).read_text(encoding='utf-8')
+        lines = (line.strip() for line in text.lower().splitlines())
+        charged_words.update(sys.intern(line) for line in lines if line)
+    return frozenset(charged_words)
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+def is_known_encoding(encoding):
+    if not encoding:
+        return False
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return False
+    return True
 
 
 async def fetch(session, url):
     async with session.get(url) as response:
         response.raise_for_status()
-        return await response.text()
+        content_length = response.content_length
+        if content_length and content_length > MAX_RESPONSE_BYTES:
+            raise ResponseTooLarge()
+
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(RESPONSE_CHUNK_BYTES):
+            body += chunk
+            if len(body) > MAX_RESPONSE_BYTES:
+                raise ResponseTooLarge()
+
+        if is_known_encoding(response.charset):
+            return body.decode(response.charset, errors='replace')
+        try:
+            return body.decode('utf-8')
+        except UnicodeDecodeError:
+            encoding = charset_normalizer.detect(bytes(body))['encoding']
+            encoding = encoding or 'utf-8'
+            return body.decode(encoding, errors='replace')
+
+
+@functools.lru_cache(maxsize=1)
+def get_morph():
+    return pymorphy3.MorphAnalyzer()
+
+
+def warm_up_analysis_worker():
+    preload_normal_forms(get_morph(), get_charged_words())
+
+
+def analyze_article(html, sanitizer_func=None, deadline=None):
+    plain_text = html
+    if sanitizer_func:
+        plain_text = sanitizer_func(html, plaintext=True)
+
+    stop_event = Deadline(deadline) if deadline else None
+    article_words = split_by_words_sync(get_morph(), plain_text, stop_event)
+    score = calculate_jaundice_rate(article_words, get_charged_words())
+    return score, len(article_words)
+
+
+class AnalysisPool:
+    """Process pool for analyze_article, replaced when a worker dies."""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count()
+        self.executor = self._create_executor()
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            initializer=warm_up_analysis_worker,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+
+    async def warm_up(self):
+        """Start all workers and wait until they have loaded the analyzer.
+
+        Spawned workers start lazily on submit, one per busy worker, so
+        max_workers simultaneous submissions start all of them.
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(self.executor, warm_up_analysis_worker)
+            for _ in range(self.max_workers)
+        ])
+
+    async def replace_broken(self, broken_executor):
+        if self.executor is not broken_executor:
+            return
+        logger.error('Analysis process pool is broken, start a new one')
+        self.executor = self._create_executor()
+        broken_executor.shutdown(wait=False, cancel_futures=True)
+        await self.warm_up()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
 
 async def process_article(
     session,
-    morph,
-    charged_words,
     url,
-    processing_outputs,
-    sanitizer_func=None
+    sanitizer_func=None,
+    executor=None,
+    fetch_semaphore=None
 ):
-    score = None
-    word_number = None
-    processing_time = None
     try:
-        async with timeout(TIMEOUT_SECONDS) as timeout_manager:
-            html = await fetch(session, url)
+        async with fetch_semaphore or contextlib.nullcontext():
+            async with asyncio.timeout(TIMEOUT_SECONDS) as timeout_manager:
+                html = await fetch(session, url)
     except (ClientConnectorError, InvalidURL, ClientResponseError):
-        logger.warning(f'Can not connect to "{url}"')
-        status = ProcessingStatus.FETCH_ERROR
-        output = (url, status, score, word_number, processing_time)
-        processing_outputs.append(output)
-        return
+        logger.warning('Can not connect to "%s"', url)
+        return url, ProcessingStatus.FETCH_ERROR, None, None, None
+    except ResponseTooLarge:
+        logger.warning('Response from "%s" is too large', url)
+        return url, ProcessingStatus.TOO_LARGE, None, None, None
     except asyncio.TimeoutError:
-        if not timeout_manager.expired:
+        if not timeout_manager.expired():
             raise
-        status = ProcessingStatus.TIMEOUT
-        output = (url, status, score, word_number, processing_time)
-        processing_outputs.append(output)
-        return
+        return url, ProcessingStatus.TIMEOUT, None, None, None
 
-    plain_text = html
-    if sanitizer_func:
-        try:
-            plain_text = sanitizer_func(html, plaintext=True)
-        except exceptions.ArticleNotFound:
-            logger.warning(f'No article found on "{url}"')
-            status = ProcessingStatus.PARSING_ERROR
-            output = (url, status, score, word_number, processing_time)
-            processing_outputs.append(output)
-            return
+    if sanitizer_func is reject_unsupported_site:
+        logger.warning('No adapter for "%s"', url)
+        return url, ProcessingStatus.PARSING_ERROR, None, None, None
 
+    deadline = time.monotonic() + TIMEOUT_SECONDS
+    start_time = time.perf_counter()
     try:
-        async with timeout(TIMEOUT_SECONDS) as timeout_manager:
-            article_words = await split_by_words(morph, plain_text)
+        async with asyncio.timeout(TIMEOUT_SECONDS) as timeout_manager:
+            loop = asyncio.get_running_loop()
+            score, word_number = await loop.run_in_executor(
+                executor,
+                analyze_article,
+                html,
+                sanitizer_func,
+                deadline
+            )
+    except exceptions.ArticleNotFound:
+        logger.warning('No article found on "%s"', url)
+        return url, ProcessingStatus.PARSING_ERROR, None, None, None
+    except BrokenProcessPool:
+        logger.error('Analysis worker died while processing "%s"', url)
+        return url, ProcessingStatus.PROCESSING_ERROR, None, None, None
+    except SplittingInterrupted:
+        logger.debug('Timeout exceeded while processing an article on %s', url)
+        return url, ProcessingStatus.TIMEOUT, None, None, TIMEOUT_SECONDS
     except asyncio.TimeoutError:
-        if not timeout_manager.expired:
+        if not timeout_manager.expired():
             raise
-        logger.debug(f'Timeout exceeded while processing an article on {url}')
-        status = ProcessingStatus.TIMEOUT
-        processing_time = TIMEOUT_SECONDS
-        output = (url, status, score, word_number, processing_time)
-        processing_outputs.append(output)
-        return
-
-    status = ProcessingStatus.OK
-    score = calculate_jaundice_rate(article_words, charged_words)
-    word_number = len(article_words)
-    processing_time = TIMEOUT_SECONDS - timeout_manager.remaining
-    logger.debug(f'{url} has been processed in {processing_time} seconds')
-    processing_output = (url, status, score, word_number, processing_time)
-    processing_outputs.append(processing_output)
-
-
-async def handle_root_get_request(morph, charged_words, request):
-    logger.info(f'Request handling started: {request}')
+        logger.debug('Timeout exceeded while processing an article on %s', url)
+        return url, ProcessingStatus.TIMEOUT, None, None, TIMEOUT_SECONDS
+
+    processing_time = time.perf_counter() - start_time
+    logger.debug('%s has been processed in %s seconds', url, processing_time)
+    return url, ProcessingStatus.OK, score, word_number, processing_time
+
+
+def json_response(data):
+    return web.Response(
+        body=orjson.dumps(data),
+        content_type='application/json',
+        charset='utf-8'
+    )
+
+
+async def handle_root_get_request(request):
+    logger.info('Request handling started: %s', request)
+    session = request.app['session']
+    analysis_pool = request.app['analysis_pool']
+    analysis_executor = analysis_pool.executor
+    fetch_semaphore = request.app['fetch_semaphore']
     urls_parameter_value = request.query.get('urls')
     if not urls_parameter_value:
-        return web.json_response({})
+        return json_response({})
 
     requested_urls = urls_parameter_value.split(',')
     if len(requested_urls) > 10:
@@ -118,35 +241,54 @@ async def handle_root_get_request(morph, charged_words, request):
         logger.warning(error_message)
         raise web.HTTPBadRequest(
             content_type='application/json',
-            text=json.dumps({'error': error_message})
+            charset='utf-8',
+            body=orjson.dumps({'error': error_message})
         )
 
-    async with aiohttp.ClientSession() as session:
-        processing_results = []
-        async with create_task_group() as task_group:
-            for article_url in requested_urls:
-                await task_group.spawn(
-                    process_article,
+    results_cache = request.app['results_cache']
+    unique_urls = list(dict.fromkeys(requested_urls))
+    results_by_url = {}
+    for url in unique_urls:
+        cached_result = results_cache.get(url)
+        if cached_result is not None:
+            results_by_url[url] = cached_result
+    async with asyncio.TaskGroup() as task_group:
+        tasks = [
+            task_group.create_task(
+                process_article(
                     session,
-                    morph,
-                    charged_words,
                     article_url,
-                    processing_results,
-                    SANITIZERS['inosmi_ru']
+                    get_sanitizer(article_url),
+                    analysis_executor,
+                    fetch_semaphore
                 )
+            )
+            for article_url in unique_urls
+            if article_url not in results_by_url
+        ]
 
-        response = []
-        for url, status, score, word_number, _ in processing_results:
-            url_result = {
-                'status': status.name,
-                'url': url,
-                'score': score,
-                'words_count': word_number
-            }
-            response.append(url_result)
+    for task in tasks:
+        processing_result = task.result()
+        url, status, *_ = processing_result
+        results_by_url[url] = processing_result
+        if status == ProcessingStatus.OK:
+            results_cache[url] = processing_result
+        elif status == ProcessingStatus.PROCESSING_ERROR:
+            await analysis_pool.replace_broken(analysis_executor)
 
-    logger.info(f'Response body: {response}')
-    return web.json_response(response)
+    response = []
+    for article_url in requested_urls:
+        url, status, score, word_number, _ = results_by_url[article_url]
+        url_result = {
+            'status': status,
+            'url': url,
+            'score': score,
+            'words_count': word_number
+        }
+        response.append(url_result)
+
+    logger.info('Response body: %s', response)
+    return json_response(response)
 
 
 @pytest.mark.parametrize(
@@ -177,21 +319,15 @@ async def handle_root_get_request(morph, charged_words, request):
 )
 @pytest.mark.parametrize('anyio_backend', ['asyncio'])
 async def test_process_article(anyio_backend, expected_status_per_url):
-    processing_ouputs = []
     async with aiohttp.ClientSession() as session:
-        morph = pymorphy2.MorphAnalyzer()
-        charged_words = get_charged_words()
-        async with create_task_group() as task_group:
-            for article_url in expected_status_per_url:
-                await task_group.spawn(
-                    process_article,
-                    session,
-                    morph,
-                    charged_words,
-                    article_url,
-                    processing_ouputs,
-                    SANITIZERS['inosmi_ru']
-                )
+        processing_ouputs = await asyncio.gather(*[
+            process_article(
+                session,
+                article_url,
+                SANITIZERS['inosmi_ru']
+            )
+            for article_url in expected_status_per_url
+        ])
 
     assert len(processing_ouputs) == len(expected_status_per_url)
     for processing_output in processing_ouputs:
@@ -212,19 +348,8 @@ async def test_process_article(anyio_backend, expected_status_per_url):
 async def test_too_big_article(anyio_backend):
     url = 'https://dvmn.org/media/filer_public/51/83/51830f54-7ec7-4702-847b-c5790ed3724c/gogol_nikolay_taras_bulba_-_bookscafenet.txt'
     async with aiohttp.ClientSession() as session:
-        morph = pymorphy2.MorphAnalyzer()
-        charged_words = get_charged_words()
-        processing_outputs = []
-        await process_article(
-            session,
-            morph,
-            charged_words,
-            url,
-            processing_outputs
-        )
+        processing_output = await process_article(session, url)
 
-    assert len(processing_outputs) == 1
-    processing_output = processing_outputs[0]
     assert len(processing_output) == 5
     returned_url, status, score, word_num, processing_time = processing_output
     assert returned_url == url
@@ -232,3 +357,234 @@ async def test_too_big_article(anyio_backend):
     assert all(
         [score is None, word_num is None, processing_time == TIMEOUT_SECONDS]
     )
+
+
+@contextlib.asynccontextmanager
+async def _serve_routes(routes):
+    from aiohttp.test_utils import TestServer
+
+    application = web.Application()
+    application.add_routes(routes)
+    async with TestServer(application) as server:
+        yield server
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_process_article_in_analysis_pool(anyio_backend):
+    async def handle_article(request):
+        html = (
+            '<article class="article">'
+            '<p>Во-первых, он хочет, чтобы</p>'
+            '</article>'
+        )
+        return web.Response(text=html, content_type='text/html')
+
+    async def handle_page_without_article(request):
+        return web.Response(text='<p>No article</p>', content_type='text/html')
+
+    routes = [
+        web.get('/article', handle_article),
+        web.get('/page', handle_page_without_article)
+    ]
+    analysis_pool = AnalysisPool(max_workers=1)
+    try:
+        await analysis_pool.warm_up()
+        async with _serve_routes(routes) as server:
+            async with aiohttp.ClientSession() as session:
+                article_result, page_result = await asyncio.gather(*[
+                    process_article(
+                        session,
+                        str(server.make_url(path)),
+                        SANITIZERS['inosmi_ru'],
+                        analysis_pool.executor
+                    )
+                    for path in ['/article', '/page']
+                ])
+
+        loop = asyncio.get_running_loop()
+        with pytest.raises(SplittingInterrupted):
+            await loop.run_in_executor(
+                analysis_pool.executor,
+                analyze_article,
+                'Во-первых, он хочет, чтобы',
+                None,
+                time.monotonic()
+            )
+    finally:
+        analysis_pool.shutdown()
+
+    _, status, score, word_num, _ = article_result
+    assert status == ProcessingStatus.OK
+    assert score == 0.0
+    assert word_num == 3
+    assert page_result[1] == ProcessingStatus.PARSING_ERROR
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_fetch_queue_does_not_count_towards_timeout(
+    anyio_backend,
+    monkeypatch
+):
+    async def handle_slow_page(request):
+        await asyncio.sleep(0.6)
+        return web.Response(text='Во-первых, он хочет, чтобы')
+
+    monkeypatch.setattr(sys.modules[__name__], 'TIMEOUT_SECONDS', 1)
+    fetch_semaphore = asyncio.Semaphore(1)
+    async with _serve_routes([web.get('/', handle_slow_page)]) as server:
+        connector = aiohttp.TCPConnector(limit_per_host=1)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            processing_outputs = await asyncio.gather(*[
+                process_article(
+                    session,
+                    str(server.make_url(f'/?page={page}')),
+                    fetch_semaphore=fetch_semaphore
+                )
+                for page in range(3)
+            ])
+
+    assert [output[1] for output in processing_outputs] == [
+        ProcessingStatus.OK
+    ] * 3
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_fetch_too_large_response(anyio_backend, monkeypatch):
+    async def handle_page(request):
+        return web.Response(text='x' * 100)
+
+    async def handle_chunked_page(request):
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for _ in range(10):
+            await response.write(b'x' * 10)
+        await response.write_eof()
+        return response
+
+    monkeypatch.setattr(sys.modules[__name__], 'MAX_RESPONSE_BYTES', 50)
+    routes = [
+        web.get('/page', handle_page),
+        web.get('/chunked', handle_chunked_page)
+    ]
+    async with _serve_routes(routes) as server:
+        async with aiohttp.ClientSession() as session:
+            for path in ['/page', '/chunked']:
+                with pytest.raises(ResponseTooLarge):
+                    await fetch(session, server.make_url(path))
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_fetch_decodes_response(anyio_backend):
+    text = 'Во-первых, он хочет, чтобы это стало началом. ' * 20
+
+    def make_handler(body, content_type):
+        async def handle_page(request):
+            return web.Response(
+                body=body,
+                headers={'Content-Type': content_type}
+            )
+        return handle_page
+
+    routes = [
+        web.get('/utf8', make_handler(text.encode('utf-8'), 'text/plain')),
+        web.get('/cp1251', make_handler(text.encode('cp1251'), 'text/plain')),
+        web.get(
+            '/unknown-charset',
+            make_handler(text.encode('utf-8'), 'text/plain; charset=win-1251')
+        ),
+        web.get(
+            '/declared-charset',
+            make_handler(text.encode('cp1251'), 'text/plain; charset=cp1251')
+        ),
+    ]
+    async with _serve_routes(routes) as server:
+        async with aiohttp.ClientSession() as session:
+            for route in routes:
+                url = server.make_url(route.path)
+                assert await fetch(session, url) == text
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_process_article_unsupported_site(anyio_backend):
+    async def handle_page(request):
+        return web.Response(text='<p>No adapter for this site</p>')
+
+    # Any submission to a shut down executor raises RuntimeError
+    executor = ThreadPoolExecutor()
+    executor.shutdown()
+    async with _serve_routes([web.get('/', handle_page)]) as server:
+        async with aiohttp.ClientSession() as session:
+            processing_output = await process_article(
+                session,
+                str(server.make_url('/')),
+                reject_unsupported_site,
+                executor
+            )
+
+    assert processing_output[1:] == (
+        ProcessingStatus.PARSING_ERROR, None, None, None
+    )
+
+
+def test_get_charged_words():
+    charged_words = get_charged_words()
+
+    assert 'новый год' in charged_words
+    assert 'добро' in charged_words
+    assert 'год' not in charged_words
+    assert '' not in charged_words
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_root_get_request_deduplicates_and_caches(
+    anyio_backend,
+    monkeypatch
+):
+    from types import SimpleNamespace
+
+    from aiohttp.test_utils import make_mocked_request
+    from cachetools import TTLCache
+
+    processed_urls = []
+
+    async def fake_process_article(session, url, *args):
+        processed_urls.append(url)
+        if 'broken' in url:
+            return url, ProcessingStatus.FETCH_ERROR, None, None, None
+        return url, ProcessingStatus.OK, 1.0, 100, 0.1
+
+    monkeypatch.setattr(
+        sys.modules[__name__],
+        'process_article',
+        fake_process_article
+    )
+    application = web.Application()
+    application['session'] = None
+    application['analysis_pool'] = SimpleNamespace(executor=None)
+    application['fetch_semaphore'] = None
+    application['results_cache'] = TTLCache(maxsize=10, ttl=60)
+    requested_urls = [
+        'https://inosmi.ru/1.html',
+        'https://broken.org',
+        'https://inosmi.ru/1.html'
+    ]
+    request_path = f'/?urls={",".join(requested_urls)}'
+
+    response = await handle_root_get_request(
+        make_mocked_request('GET', request_path, app=application)
+    )
+
+    assert processed_urls == ['https://inosmi.ru/1.html', 'https://broken.org']
+    url_results = orjson.loads(response.body)
+    assert [result['url'] for result in url_results] == requested_urls
+    assert [result['status'] for result in url_results] == [
+        'OK', 'FETCH_ERROR', 'OK'
+    ]
+
+    processed_urls.clear()
+    await handle_root_get_request(
+        make_mocked_request('GET', request_path, app=application)
+    )
+
+    assert processed_urls == ['https://broken.org']
@@ -1,26 +1,81 @@
-import functools
+import asyncio
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
 
+import aiohttp
 from aiohttp import web
-import pymorphy2
+from cachetools import TTLCache
 
-from main import handle_root_get_request, get_charged_words
+from main import AnalysisPool, handle_root_get_request
 
 logger = logging.getLogger('server')
 
+RESULTS_CACHE_SIZE = 1000
+RESULTS_CACHE_TTL_SECONDS = 300
+MAX_CONCURRENT_FETCHES = 4
+
+
+async def create_analysis_pool(application):
+    analysis_pool = AnalysisPool()
+    await analysis_pool.warm_up()
+    application['analysis_pool'] = analysis_pool
+
+
+async def shutdown_analysis_pool(application):
+    application['analysis_pool'].shutdown()
+
+
+async def create_results_cache(application):
+    application['results_cache'] = TTLCache(
+        maxsize=RESULTS_CACHE_SIZE,
+        ttl=RESULTS_CACHE_TTL_SECONDS
+    )
+
+
+async def create_client_session(application):
+    connector = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=MAX_CONCURRENT_FETCHES,
+        ttl_dns_cache=300,
+        keepalive_timeout=60
+    )
+    application['session'] = aiohttp.ClientSession(connector=connector)
+    # Not more fetches than pooled connections to one host, otherwise
+    # a fetch waits for a connection inside its timeout
+    application['fetch_semaphore'] = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+
+
+async def close_client_session(application):
+    await application['session'].close()
+
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.ERROR)
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(
+        level=logging.ERROR,
+        handlers=[QueueHandler(log_queue)]
+    )
+    log_listener = QueueListener(log_queue, logging.StreamHandler())
+    log_listener.start()
     logger.setLevel(logging.DEBUG)
 
-    morph = pymorphy2.MorphAnalyzer()
-    charged_words = get_charged_words()
-    prepared_root_get_handler = functools.partial(
-        handle_root_get_request,
-        morph,
-        charged_words
-    )
+    try:
+        import uvloop
+    except ImportError:
+        logger.debug('uvloop is not installed, use the default event loop')
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     application = web.Application()
-    application.add_routes([web.get('/', prepared_root_get_handler)])
+    application.on_startup.append(create_analysis_pool)
+    application.on_startup.append(create_client_session)
+    application.on_startup.append(create_results_cache)
+    application.on_cleanup.append(close_client_session)
+    application.on_cleanup.append(shutdown_analysis_pool)
+    application.add_routes([web.get('/', handle_root_get_request)])
 
-    web.run_app(application)
+    try:
+        web.run_app(application)
+    finally:
+        log_listener.stop()
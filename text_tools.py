@@ -1,31 +1,92 @@
 import asyncio
-import pymorphy2
-import string
+import functools
+import pymorphy3
+import pytest
+import re
+import sys
+import threading
+import time
 
+# Слова из букв, в том числе составные через дефис: "во-первых", "кто-то"
+_TOKEN_RE = re.compile(r'[^\W\d_]+(?:-[^\W\d_]+)*')
 
-def _clean_word(word):
-    word = word.replace('«', '').replace('»', '').replace('…', '')
-    # FIXME какие еще знаки пунктуации часто встречаются ?
-    word = word.strip(string.punctuation)
-    return word
+STOP_CHECK_INTERVAL = 1000
+
+
+class SplittingInterrupted(Exception):
+    pass
+
+
+class Deadline:
+    """Замена threading.Event для другого процесса.
+
+    Считается установленной, когда time.monotonic() доходит до deadline.
+    """
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+
+    def is_set(self):
+        return time.monotonic() >= self.deadline
+
+
+def _tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+
+# Словоформы в текстах часто повторяются, а morph.parse - самая медленная часть разбора
+# Кэш общий для всех статей и запросов в пределах процесса
+# Нормальные формы интернируются, как и "заряженные" слова, и при поиске сравниваются по ссылке
+@functools.lru_cache(maxsize=200_000)
+def _normalize_word(morph, word):
+    return sys.intern(morph.parse(word)[0].normal_form)
+
+
+def preload_normal_forms(morph, words):
+    """Заранее заполняет кэш нормальных форм, например "заряженными" словами."""
+    for word in words:
+        _normalize_word(morph, word.lower())
+
+
+def _is_significant(normalized_word):
+    return len(normalized_word) > 2 or normalized_word == 'не'
 
 
 async def split_by_words(morph, text):
     """Учитывает знаки пунктуации, регистр и словоформы, выкидывает предлоги."""
     words = []
-    for word in text.split():
-        cleaned_word = _clean_word(word)
-        normalized_word = morph.parse(cleaned_word)[0].normal_form
-        if len(normalized_word) > 2 or normalized_word == 'не':
+    for word in _tokenize(text):
+        normalized_word = _normalize_word(morph, word)
+        if _is_significant(normalized_word):
             words.append(normalized_word)
         await asyncio.sleep(0)
     return words
 
 
+def split_by_words_sync(morph, text, stop_event=None):
+    """Синхронная версия split_by_words для запуска в потоке или процессе.
+
+    Если передан stop_event (threading.Event или Deadline), то каждые STOP_CHECK_INTERVAL слов
+    проверяет его и прерывает разбор исключением SplittingInterrupted.
+    """
+    words = []
+    for word_index, word in enumerate(_tokenize(text)):
+        if (
+            stop_event
+            and word_index % STOP_CHECK_INTERVAL == 0
+            and stop_event.is_set()
+        ):
+            raise SplittingInterrupted()
+        normalized_word = _normalize_word(morph, word)
+        if _is_significant(normalized_word):
+            words.append(normalized_word)
+    return words
+
+
 def test_split_by_words():
     # Экземпляры MorphAnalyzer занимают 10-15Мб RAM т.к. загружают в память много данных
     # Старайтесь организовать свой код так, чтоб создавать экземпляр MorphAnalyzer заранее и в единственном числе
-    morph = pymorphy2.MorphAnalyzer()
+    morph = pymorphy3.MorphAnalyzer()
 
     text_words = asyncio.run(
         split_by_words(
@@ -46,15 +107,56 @@ def test_split_by_words():
     assert text_words == ['удивительно', 'это', 'стать', 'начало']
 
 
+def test_tokenize():
+    assert _tokenize('Во-первых, он хочет, чтобы…') == [
+        'во-первых', 'он', 'хочет', 'чтобы'
+    ]
+    assert _tokenize('«Удивительно, но 2020 год — это начало!»') == [
+        'удивительно', 'но', 'год', 'это', 'начало'
+    ]
+
+
+def test_split_by_words_sync():
+    morph = pymorphy3.MorphAnalyzer()
+
+    text_words = split_by_words_sync(morph, 'Во-первых, он хочет, чтобы')
+    assert text_words == ['во-первых', 'хотеть', 'чтобы']
+
+    text_words = split_by_words_sync(
+        morph,
+        '«Удивительно, но это стало началом!»'
+    )
+    assert text_words == ['удивительно', 'это', 'стать', 'начало']
+
+
+def test_split_by_words_sync_interrupted():
+    morph = pymorphy3.MorphAnalyzer()
+    stop_event = threading.Event()
+    stop_event.set()
+
+    with pytest.raises(SplittingInterrupted):
+        split_by_words_sync(morph, 'Во-первых, он хочет, чтобы', stop_event)
+
+    with pytest.raises(SplittingInterrupted):
+        split_by_words_sync(morph, 'Во-первых, он хочет, чтобы', Deadline(0))
+
+
 def calculate_jaundice_rate(article_words, charged_words):
-    """Расчитывает желтушность текста, принимает список "заряженных" слов и ищет их внутри article_words."""
+    """Расчитывает желтушность текста, принимает множество "заряженных" слов и ищет их внутри article_words.
+
+    Для быстрого поиска charged_words стоит передавать как set или frozenset,
+    другие коллекции один раз преобразуются во frozenset.
+    """
 
     if not article_words:
         return 0.0
 
-    found_charged_words = [word for word in article_words if word in set(charged_words)]
+    if not isinstance(charged_words, (set, frozenset)):
+        charged_words = frozenset(charged_words)
+
+    charged_words_count = sum(map(charged_words.__contains__, article_words))
 
-    score = len(found_charged_words) / len(article_words) * 100
+    score = charged_words_count / len(article_words) * 100
 
     return round(score, 2)
 
@@ -62,3 +164,4 @@ def calculate_jaundice_rate(article_words, charged_words):
 def test_calculate_jaundice_rate():
     assert -0.01 < calculate_jaundice_rate([], []) < 0.01
     assert 33.0 < calculate_jaundice_rate(['все', 'аутсайдер', 'побег'], ['аутсайдер', 'банкротство']) < 34.0
+    assert 66.0 < calculate_jaundice_rate(['все', 'аутсайдер', 'аутсайдер'], frozenset(['аутсайдер'])) < 67.0